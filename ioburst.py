@@ -16,6 +16,7 @@ Key Features:
 Usage:
    ioburst [-h] [-d DEVICE] [--bandwidth MB/S] [--iops IOPS]
            [-c COUNT] [-i INTERVAL] [-v] [-p PID] [-m|-s|-u|-n]
+           [--buffer-pages PAGES] [--avoid-irq-cpus]
 
 Examples:
    # Monitor /dev/nvme0n1 with verbose burst-only output:
@@ -34,35 +35,61 @@ Notes:
    - IOs exceeding device thresholds are recorded as burst operations.
    - Histograms at the end display both counts and total time spent in each latency bucket.
    - Units can be adjusted with -m, -s, -u, -n or left as humanized by default.
+   - Latency histograms are built from the event ring buffer. If IO rates are high
+     enough to fill it, raise --buffer-pages.
 """
 
 import argparse
-import math
-from pathlib import Path
+import functools
 from bcc import BPF
 import os
+import re
 import time
 import ctypes as ct
+import numpy as np
 from datetime import datetime
 from collections import defaultdict
 
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    # Numba is optional; without it the NumPy accumulate_latencies is used.
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 ################################################################################
 # BPF Program (in bpf_text)
 #
 # This bpf code tracks per-request latency by capturing block_rq_issue and
-# block_rq_complete events. It logs normal vs. burst IO based on bandwidth/IOPS
-# thresholds and stores latency histograms. It uses two histograms: one for
-# standard IO operations and one for burst IO operations that exceeded given
-# thresholds. It also maintains per-device cumulative stats and concurrency
-# information.
+# block_rq_complete events. It classifies normal vs. burst IO based on
+# bandwidth/IOPS thresholds and streams each completion, with its latency, to
+# userspace. Userspace keeps two latency histograms: one for standard IO
+# operations and one for burst IO operations that exceeded given thresholds.
+# It also maintains per-device cumulative stats and concurrency
+# information. Per-device accounting lives in a per-CPU map so the hot path
+# increments CPU-local counters; only the burst predicate and concurrency are
+# kept in a shared map, updated atomically.
 #
-#  - Use log2 histograms for latency.
+#  - Latency histograms are log2-based and built in userspace from the event
+#    stream, keeping the completion path free of histogram map updates.
 #  - Maintains burst counters for IOs and bytes over the configured limits.
+#    The limits are substituted into the program text before it is compiled
+#    (BYTES_PER_SEC_LIMIT, IOPS_PER_SEC_LIMIT), so they are immediates rather
+#    than map lookups.
 #  - Tracks concurrency to understand peak parallelism.
-#  - A "burst" IO is defined as one completed during a period where limits
-#    (bandwidth or IOPS) were exceeded.
-#  - Requests are keyed by device, sector, and rwbs string to correlate issue
-#    and completion events.
+#  - A "burst" IO is defined as one issued during a period where limits
+#    (bandwidth or IOPS) were exceeded. The decision is made once at issue and
+#    carried to the completion in the request's rq_val.
+#  - Requests are keyed by a fixed-size device and sector struct to correlate
+#    issue and completion events without collisions across devices.
+#  - Completed IOs are streamed to userspace through a single ring buffer shared
+#    by all CPUs, so events arrive in order and without per-CPU buffer waste.
+#    Wakeups are coalesced until the buffer is a quarter full.
+#  - Events carry only the fields needed for the histograms, with rwbs packed
+#    into a bitmask. The issuing comm is captured only when the program is
+#    built with EVENT_COMM, which main() defines for verbose output.
 ################################################################################
 
 bpf_text = r"""
@@ -72,112 +99,156 @@ bpf_text = r"""
 
 #define RWBS_LEN 8
 #define COMM_LEN 16
-
-struct io_limits {
-    u64 bytes_per_sec;
-    u64 iops_per_sec;
-};
-
+#define RINGBUF_PAGES RINGBUF_PAGE_COUNT
+#define RINGBUF_WAKEUP_BYTES (RINGBUF_PAGES * PAGE_SIZE / 4)
+#define CAS_RETRIES 4
+
+// rwbs_flags packs the tracepoint's rwbs string: the low bits hold the
+// operation and the high bits its modifiers. Mirrored in userspace.
+#define RWBS_OP_MASK         0x07
+#define RWBS_OP_NONE         0
+#define RWBS_OP_READ         1
+#define RWBS_OP_WRITE        2
+#define RWBS_OP_DISCARD      3
+#define RWBS_OP_SECURE_ERASE 4
+#define RWBS_OP_FLUSH        5
+#define RWBS_PREFLUSH        0x08
+#define RWBS_FUA             0x10
+#define RWBS_RAHEAD          0x20
+#define RWBS_SYNC            0x40
+#define RWBS_META            0x80
+
+// In-flight requests are keyed by device and full start sector; the explicit
+// pad keeps the 16-byte key free of uninitialized bytes
+#define RQ_KEY(d, s) ((struct rq_key){ .dev = (d), .pad = 0, .sector = (s) })
+
+// Per-CPU accounting, summed across CPUs in userspace. Every counter is
+// cumulative and only written by BPF; userspace derives rates from deltas.
 struct io_stats {
     u64 bytes;
     u64 iops;
-    u64 last_update;
     u64 burst_bytes;
     u64 burst_iops;
-    u64 current_concurrent;
-    u64 max_concurrent;
     u64 total_normal_bytes;
     u64 total_normal_iops;
     u64 total_burst_bytes;
     u64 total_burst_iops;
 };
 
+// Shared per-device state used for the burst predicate and concurrency.
+// Only BPF writes it; max_concurrent restarts when interval_gen moves past gen.
+struct io_window {
+    u64 bytes;
+    u64 iops;
+    u64 last_update;
+    u64 current_concurrent;
+    u64 max_concurrent;
+    u64 gen;
+};
+
 struct rq_key {
     u32 dev;
+    u32 pad;
     u64 sector;
-    u32 nr_sector;
-    char rwbs[RWBS_LEN];
 };
 
 struct rq_val {
     u64 start_ns;
     u32 tgid;
+#ifdef EVENT_COMM
     char comm[COMM_LEN];
+#endif
     u8 is_burst;
 };
 
-struct hist_key {
-    u32 dev;
-    u32 bucket;
-};
-
-struct hist_data {
-    u64 count;
-    u64 total_time_us;
-};
-
 struct event_data {
     u32 dev;
-    u64 latency_us;
-    u64 size;
-    char rwbs[RWBS_LEN];
-    char comm[COMM_LEN];
+    u32 latency_us;
+    u32 size_sectors;
+    u8 rwbs_flags;
     u8 is_burst;
+#ifdef EVENT_COMM
+    char comm[COMM_LEN];
+#endif
 };
 
 BPF_HASH(requests, struct rq_key, struct rq_val);
-BPF_HASH(latency_hist_normal, struct hist_key, struct hist_data);
-BPF_HASH(latency_hist_burst, struct hist_key, struct hist_data);
-BPF_HASH(io_limits, u32, struct io_limits);
-BPF_HASH(io_stats, u32, struct io_stats);
+BPF_PERCPU_HASH(io_stats, u32, struct io_stats, 64);
+BPF_HASH(io_window, u32, struct io_window, 64);
+// Bumped by userspace after each printed interval
+BPF_ARRAY(interval_gen, u64, 1);
 BPF_HASH(pid_filter, u32, u8);
-BPF_HASH(filtering_enabled, u32, u8);
+BPF_ARRAY(filtering_enabled, u8, 1);
+// Completions dropped because the ring buffer was full
+BPF_PERCPU_ARRAY(lost_events, u64, 1);
 
-BPF_PERF_OUTPUT(events);
+BPF_RINGBUF_OUTPUT(events, RINGBUF_PAGES);
 
-static __always_inline void update_stats_issue(u32 dev_key, u32 nr_sector) {
-    struct io_limits *limits = io_limits.lookup(&dev_key);
-    if (!limits) return;
+// Returns 1 if the IO is a burst IO, 0 if not, or -1 if the device is not monitored
+static __always_inline int update_stats_issue(u32 dev_key, u32 nr_sector) {
+    // Only monitored devices have a window
+    struct io_window *window = io_window.lookup(&dev_key);
+    if (!window) return -1;
 
+    // Entries are created from userspace, so the lookup points at the map value
     struct io_stats *stats = io_stats.lookup(&dev_key);
+    if (!stats) return -1;
+
     u64 now = bpf_ktime_get_ns();
 
-    if (!stats) {
-        struct io_stats new_stats = {};
-        new_stats.last_update = now;
-        io_stats.update(&dev_key, &new_stats);
-        stats = io_stats.lookup(&dev_key);
-        if (!stats) return;
+    // Each second, reset counters used to check if current IOs exceed limits.
+    // Only the CPU that wins the swap on last_update performs the reset.
+    u64 last_update = window->last_update;
+    if (now - last_update > 1000000000 &&
+        __sync_val_compare_and_swap(&window->last_update, last_update, now) == last_update) {
+        window->bytes = 0;
+        window->iops = 0;
+    }
+
+    u64 bytes = (u64)nr_sector * 512ULL;
+    u64 window_bytes = __sync_fetch_and_add(&window->bytes, bytes) + bytes;
+    u64 window_iops = __sync_fetch_and_add(&window->iops, 1) + 1;
+
+    u64 concurrent = __sync_fetch_and_add(&window->current_concurrent, 1) + 1;
+
+    // The first issue of a new interval restarts the peak from the current level
+    u32 z = 0;
+    u64 *gen = interval_gen.lookup(&z);
+    if (gen) {
+        u64 window_gen = window->gen;
+        if (window_gen != *gen &&
+            __sync_val_compare_and_swap(&window->gen, window_gen, *gen) == window_gen)
+            window->max_concurrent = concurrent;
     }
 
-    // Each second, reset counters used to check if current IOs exceed limits
-    if (now - stats->last_update > 1000000000) {
-        stats->bytes = 0;
-        stats->iops = 0;
-        stats->burst_bytes = 0;
-        stats->burst_iops = 0;
-        stats->last_update = now;
+    u64 max_concurrent = window->max_concurrent;
+#pragma unroll
+    for (int i = 0; i < CAS_RETRIES && concurrent > max_concurrent; i++) {
+        u64 prev = __sync_val_compare_and_swap(&window->max_concurrent, max_concurrent, concurrent);
+        if (prev == max_concurrent)
+            break;
+        max_concurrent = prev;
     }
 
-    u64 bytes = (u64)nr_sector * 512ULL;
+    // Per-CPU counters are only touched by this CPU, so no atomics are needed
     stats->bytes += bytes;
     stats->iops++;
-    stats->current_concurrent++;
-    if (stats->current_concurrent > stats->max_concurrent)
-        stats->max_concurrent = stats->current_concurrent;
 
     // We track burst activity so we know how many IOs were over the limit.
-    if (stats->bytes > limits->bytes_per_sec || stats->iops > limits->iops_per_sec) {
+    if (window_bytes > BYTES_PER_SEC_LIMIT || window_iops > IOPS_PER_SEC_LIMIT) {
         stats->burst_bytes += bytes;
         stats->burst_iops++;
+        return 1;
     }
-
-    io_stats.update(&dev_key, stats);
+    return 0;
 }
 
-static __always_inline void update_stats_complete(u32 dev_key, u32 nr_sector, bool is_burst) {
+static __always_inline int update_stats_complete(u32 dev_key, u32 nr_sector, bool is_burst) {
+    struct io_window *window = io_window.lookup(&dev_key);
+    if (!window) return -1;
+
     struct io_stats *stats = io_stats.lookup(&dev_key);
-    if (!stats) return;
+    if (!stats) return -1;
 
     u64 bytes = (u64)nr_sector * 512ULL;
     if (is_burst) {
@@ -189,68 +260,114 @@ static __always_inline void update_stats_complete(u32 dev_key, u32 nr_sector, bo
     }
 
     // Reduce concurrency after completion
-    if (stats->current_concurrent > 0)
-        stats->current_concurrent--;
+    if (window->current_concurrent > 0)
+        __sync_fetch_and_sub(&window->current_concurrent, 1);
+    return 0;
+}
+
+static __always_inline bool rwbs_is_op(char c) {
+    return c == 'R' || c == 'W' || c == 'D' || c == 'F' || c == 'N';
+}
 
-    io_stats.update(&dev_key, stats);
+// Encode an rwbs string such as "FWS" or "WFS" into rwbs_flags. A leading 'F'
+// is a preflush when an operation follows it, otherwise it is a flush.
+static __always_inline u8 encode_rwbs(const char *rwbs) {
+    u8 flags = RWBS_OP_NONE;
+    bool have_op = false;
+
+#pragma unroll
+    for (int i = 0; i < RWBS_LEN; i++) {
+        char c = rwbs[i];
+        if (c == '\0')
+            break;
+
+        if (!have_op) {
+            if (i == 0 && c == 'F' && rwbs_is_op(rwbs[1])) {
+                flags |= RWBS_PREFLUSH;
+                continue;
+            }
+            have_op = true;
+            switch (c) {
+            case 'R': flags |= RWBS_OP_READ; break;
+            case 'W': flags |= RWBS_OP_WRITE; break;
+            case 'D': flags |= RWBS_OP_DISCARD; break;
+            case 'F': flags |= RWBS_OP_FLUSH; break;
+            default: break;
+            }
+            continue;
+        }
+
+        switch (c) {
+        case 'E':
+            // "DE" is a secure erase
+            if ((flags & RWBS_OP_MASK) == RWBS_OP_DISCARD)
+                flags = (flags & ~RWBS_OP_MASK) | RWBS_OP_SECURE_ERASE;
+            break;
+        case 'F': flags |= RWBS_FUA; break;
+        case 'A': flags |= RWBS_RAHEAD; break;
+        case 'S': flags |= RWBS_SYNC; break;
+        case 'M': flags |= RWBS_META; break;
+        default: break;
+        }
+    }
+    return flags;
 }
 
 TRACEPOINT_PROBE(block, block_rq_issue) {
+    u64 pid_tgid = bpf_get_current_pid_tgid();
+    u32 tgid = pid_tgid >> 32; // This is the process pid (tgid)
+
     u32 z = 0;
     u8 *enabled = filtering_enabled.lookup(&z);
-    if (enabled && *enabled == 1) {
-        u64 pid_tgid = bpf_get_current_pid_tgid();
-        u32 tgid = pid_tgid >> 32; // This is the process pid (tgid)
-
+    if (__builtin_expect(enabled && *enabled, 0)) {
         u8 *exists = pid_filter.lookup(&tgid);
         if (!exists) {
             return 0; // This tgid is not monitored
         }
     }
 
-    struct rq_key key = {};
-    key.dev = args->dev;
-    key.sector = args->sector;
-    key.nr_sector = args->nr_sector;
-    __builtin_memcpy(key.rwbs, args->rwbs, RWBS_LEN);
+    // Decide burst vs. normal once, at issue; the completion reuses it
+    u32 dev_key = args->dev;
+    int is_burst = update_stats_issue(dev_key, args->nr_sector);
+    if (is_burst < 0)
+        return 0;
+
+    struct rq_key key = RQ_KEY(args->dev, args->sector);
 
     struct rq_val val = {};
     val.start_ns = bpf_ktime_get_ns();
+#ifdef EVENT_COMM
     bpf_probe_read_str(val.comm, sizeof(val.comm), (void*)args->comm);
-
-    u64 pid_tgid = bpf_get_current_pid_tgid();
-    u32 tgid = pid_tgid >> 32;
+#endif
     val.tgid = tgid;
+    val.is_burst = is_burst;
 
     requests.update(&key, &val);
 
-    u32 dev_key = args->dev;
-    update_stats_issue(dev_key, args->nr_sector);
-
     return 0;
 }
 
 TRACEPOINT_PROBE(block, block_rq_complete) {
-    struct rq_key key = {};
-    key.dev = args->dev;
-    key.sector = args->sector;
-    key.nr_sector = args->nr_sector;
-    __builtin_memcpy(key.rwbs, args->rwbs, RWBS_LEN);
-
-    struct rq_val *val = requests.lookup(&key);
-    if (!val)
+    struct rq_key key = RQ_KEY(args->dev, args->sector);
+
+    struct rq_val *valp = requests.lookup(&key);
+    if (!valp)
         return 0;
 
+    // Copy the value out: once deleted, the preallocated element can be reused
+    // by another CPU's block_rq_issue
+    struct rq_val val = *valp;
+
     u64 now = bpf_ktime_get_ns();
-    u64 latency_ns = now - val->start_ns;
+    u64 latency_ns = now - val.start_ns;
 
     // Retrieve the tgid of the process that issued the IO
-    u32 tgid = val->tgid;
+    u32 tgid = val.tgid;
 
     // Check if filtering is enabled and if this tgid is allowed
     u32 z = 0;
     u8 *enabled = filtering_enabled.lookup(&z);
-    if (enabled && *enabled == 1) {
+    if (__builtin_expect(enabled && *enabled, 0)) {
         u8 *exists = pid_filter.lookup(&tgid);
         if (!exists) {
             // Not a monitored tgid, remove from requests and skip processing
@@ -264,55 +381,35 @@ TRACEPOINT_PROBE(block, block_rq_complete) {
 
     u64 latency_us = latency_ns / 1000;
 
-    u32 dev_key = args->dev;
-    struct io_stats *stats = io_stats.lookup(&dev_key);
-    if (!stats) return 0;
-    struct io_limits *limits = io_limits.lookup(&dev_key);
-    if (!limits) return 0;
-
-    // Determine if over limits
-    bool over_limits = false;
-    if (stats->bytes > limits->bytes_per_sec || stats->iops > limits->iops_per_sec) {
-        u64 bytes = (u64)args->nr_sector * 512ULL;
-        stats->burst_bytes += bytes;
-        stats->burst_iops++;
-        over_limits = true;
-    }
-
-    bool is_burst = over_limits;
-    update_stats_complete(args->dev, args->nr_sector, is_burst);
-
-    // Log latency in the appropriate histogram
-    u64 bucket = bpf_log2l(latency_us);
-    struct hist_key hkey = {
-        .dev = args->dev,
-        .bucket = (u32)bucket
-    };
-
-    struct hist_data init_val = {};
-    struct hist_data *histp;
-    if (is_burst) {
-        histp = latency_hist_burst.lookup_or_init(&hkey, &init_val);
-    } else {
-        histp = latency_hist_normal.lookup_or_init(&hkey, &init_val);
-    }
+    bool is_burst = val.is_burst;
+    if (update_stats_complete(args->dev, args->nr_sector, is_burst) < 0)
+        return 0;
 
-    if (histp) {
-        histp->count += 1;
-        histp->total_time_us += latency_us;
+    // Submit event for the latency histograms and verbose output, written in
+    // place in the ring buffer
+    struct event_data *evt = events.ringbuf_reserve(sizeof(*evt));
+    if (!evt) {
+        u32 zero = 0;
+        u64 *lost = lost_events.lookup(&zero);
+        if (lost)
+            (*lost)++;
+        return 0;
     }
 
-    // Submit event for verbose output
-    struct event_data evt = {};
-    evt.dev = args->dev;
-    evt.latency_us = latency_us;
-    u64 bytes = (u64)args->nr_sector * 512ULL;
-    evt.size = bytes;
-    __builtin_memcpy(evt.rwbs, args->rwbs, RWBS_LEN);
-    __builtin_memcpy(evt.comm, val->comm, COMM_LEN);
-    evt.is_burst = is_burst ? 1 : 0;
-
-    events.perf_submit(args, &evt, sizeof(evt));
+    evt->dev = args->dev;
+    evt->latency_us = latency_us > 0xffffffff ? 0xffffffff : (u32)latency_us;
+    evt->size_sectors = args->nr_sector;
+    evt->rwbs_flags = encode_rwbs(args->rwbs);
+    evt->is_burst = is_burst ? 1 : 0;
+#ifdef EVENT_COMM
+    __builtin_memcpy(evt->comm, val.comm, COMM_LEN);
+#endif
+
+    // Only wake userspace once a quarter of the buffer is pending; the poll
+    // loop drains anything left below the threshold on each interval.
+    u64 avail = events.ringbuf_query(BPF_RB_AVAIL_DATA);
+    u64 flags = avail > RINGBUF_WAKEUP_BYTES ? BPF_RB_FORCE_WAKEUP : BPF_RB_NO_WAKEUP;
+    events.ringbuf_submit(evt, flags);
 
     return 0;
 }
@@ -322,83 +419,196 @@ TRACEPOINT_PROBE(block, block_rq_complete) {
 # CTYPE STRUCTS
 ################################################################################
 
-class IOLimits(ct.Structure):
-    _fields_ = [
-        ("bytes_per_sec", ct.c_uint64),
-        ("iops_per_sec", ct.c_uint64)
-    ]
-
 class IOStats(ct.Structure):
     _fields_ = [
         ("bytes", ct.c_uint64),
         ("iops", ct.c_uint64),
-        ("last_update", ct.c_uint64),
         ("burst_bytes", ct.c_uint64),
         ("burst_iops", ct.c_uint64),
-        ("current_concurrent", ct.c_uint64),
-        ("max_concurrent", ct.c_uint64),
         ("total_normal_bytes", ct.c_uint64),
         ("total_normal_iops", ct.c_uint64),
         ("total_burst_bytes", ct.c_uint64),
         ("total_burst_iops", ct.c_uint64)
     ]
 
-class HistKey(ct.Structure):
-    _fields_ = [
-        ("dev", ct.c_uint32),
-        ("bucket", ct.c_uint32),
-    ]
-
-class HistData(ct.Structure):
+class IOWindow(ct.Structure):
     _fields_ = [
-        ("count", ct.c_uint64),
-        ("total_time_us", ct.c_uint64)
+        ("bytes", ct.c_uint64),
+        ("iops", ct.c_uint64),
+        ("last_update", ct.c_uint64),
+        ("current_concurrent", ct.c_uint64),
+        ("max_concurrent", ct.c_uint64),
+        ("gen", ct.c_uint64)
     ]
 
 class EventData(ct.Structure):
     _fields_ = [
         ("dev", ct.c_uint32),
-        ("latency_us", ct.c_uint64),
-        ("size", ct.c_uint64),
-        ("rwbs", ct.c_char * 8),
-        ("comm", ct.c_char * 16),
+        ("latency_us", ct.c_uint32),
+        ("size_sectors", ct.c_uint32),
+        ("rwbs_flags", ct.c_ubyte),
         ("is_burst", ct.c_ubyte)
     ]
 
+# Layout of struct event_data when the program is built with EVENT_COMM
+class EventDataComm(ct.Structure):
+    _fields_ = EventData._fields_ + [
+        ("comm", ct.c_char * 16)
+    ]
+
 ################################################################################
 # GLOBALS
 ################################################################################
 
+HIST_BUCKETS = 64
 concurrency_hist = defaultdict(int)
+# Latency histograms indexed [is_burst, device row, log2 bucket]. Rows follow
+# hist_devs, the dev_t of each monitored device; all three are sized in main().
+hist_devs = np.zeros(0, dtype=np.int64)
+latency_counts = np.zeros((2, 0, HIST_BUCKETS), dtype=np.int64)
+latency_time_us = np.zeros((2, 0, HIST_BUCKETS), dtype=np.int64)
+# Event layout being received; main() switches to EventDataComm for verbose output
+EVENT_TYPE = EventData
+_EVT_P = ct.POINTER(EventData)
+# Completions not yet added to the histograms, kept as parallel arrays
+BATCH_SIZE = 4096
+batch_devs = np.empty(BATCH_SIZE, dtype=np.uint32)
+batch_lats = np.empty(BATCH_SIZE, dtype=np.uint32)
+batch_burst = np.empty(BATCH_SIZE, dtype=np.uint8)
+batch_len = 0
+# Copies of events awaiting verbose output, printed with their batch; main()
+# sets this to a list with -v
+verbose_events = None
+VERBOSE_LEVEL = 0
 TIME_UNIT_MODE = 'human'
+# Summed io_stats per device as of the previous print_stats, and when that was
+prev_stats = {}
+prev_stats_time = 0.0
+prev_lost_events = 0
+
+# Mirrors the RWBS_* definitions in bpf_text
+RWBS_OP_MASK = 0x07
+RWBS_OPS = {0: "N", 1: "R", 2: "W", 3: "D", 4: "DE", 5: "F"}
+RWBS_PREFLUSH = 0x08
+RWBS_MODIFIERS = ((0x10, "F"), (0x20, "A"), (0x40, "S"), (0x80, "M"))
 
 ################################################################################
 # FUNCTIONS (ALPHABETICALLY SORTED)
 ################################################################################
 
+def accumulate_latencies(devs, lats, is_burst, hist_devs, counts, time_us):
+    """
+    Add a batch of completions to the latency histograms using NumPy. Each latency
+    is filed under its floor(log2) bucket, in the row of its device.
+    """
+    # argmax below cannot reduce over an empty axis
+    if lats.size == 0 or hist_devs.size == 0:
+        return
+
+    match = devs[:, None] == hist_devs[None, :]
+    known = match.any(axis=1)
+    rows = match.argmax(axis=1)[known]
+    lats = lats[known]
+    kinds = (is_burst[known] != 0).astype(np.intp)
+
+    # frexp gives lat = m * 2**exp with 0.5 <= m < 1, so floor(log2(lat)) = exp - 1
+    buckets = np.maximum(np.frexp(lats)[1] - 1, 0)
+    np.add.at(counts, (kinds, rows, buckets), 1)
+    np.add.at(time_us, (kinds, rows, buckets), lats)
+
+@njit(cache=True)
+def accumulate_latencies_jit(devs, lats, is_burst, hist_devs, counts, time_us):
+    """
+    Loop version of accumulate_latencies, compiled by Numba when it is installed.
+    """
+    for i in range(devs.size):
+        row = -1
+        for j in range(hist_devs.size):
+            if hist_devs[j] == devs[i]:
+                row = j
+                break
+        if row < 0:
+            continue
+
+        lat = np.int64(lats[i])
+        bucket = 0
+        while lat > 1:
+            lat >>= 1
+            bucket += 1
+
+        kind = 1 if is_burst[i] else 0
+        counts[kind, row, bucket] += 1
+        time_us[kind, row, bucket] += lats[i]
+
+def device_keys(devices):
+    """
+    Stat each device once and map its path to the ctypes dev_t key used for the BPF maps.
+    Devices that cannot be found are reported and left out.
+    """
+    dev_keys = {}
+    for device in devices:
+        try:
+            st = os.stat(device)
+        except FileNotFoundError:
+            print(f"Device {device} not found")
+            continue
+        dev_keys[device] = ct.c_uint32(make_dev(os.major(st.st_rdev), os.minor(st.st_rdev)))
+    return dev_keys
+
 def discover_devices():
     """
     Discover a default set of NVMe devices to monitor, excluding the boot device if identified.
     Returns a sorted list of device paths.
     """
     boot_device = None
-    boot_link = Path('/dev/disk/by-label/BOOT')
-    if boot_link.exists():
-        boot_device = os.path.realpath(boot_link).split('p')[0]
-
-    devices = []
-    for device in Path('/sys/block').glob('nvme*n1'):
-        dev_path = f"/dev/{device.name}"
-        if boot_device and dev_path == boot_device:
-            continue
-        devices.append(dev_path)
+    boot_link = '/dev/disk/by-label/BOOT'
+    try:
+        target = os.path.join(os.path.dirname(boot_link), os.readlink(boot_link))
+        m = re.match(r'(/dev/nvme\d+n\d+)p\d+$', os.path.normpath(target))
+        if m:
+            boot_device = m.group(1)
+    except OSError:
+        pass
 
-    return sorted(devices)
+    with os.scandir('/sys/block') as it:
+        devices = [f"/dev/{entry.name}" for entry in it
+                   if entry.name.startswith('nvme') and entry.name.endswith('n1')]
 
+    return sorted(device for device in devices if device != boot_device)
+
+def flush_latencies():
+    """
+    Add the pending batch of completions to the latency histograms, print its
+    verbose events, and empty it.
+    """
+    global batch_len
+    accumulate = accumulate_latencies_jit if HAVE_NUMBA else accumulate_latencies
+    accumulate(batch_devs[:batch_len], batch_lats[:batch_len], batch_burst[:batch_len],
+               hist_devs, latency_counts, latency_time_us)
+    batch_len = 0
+
+    if verbose_events:
+        for evt in verbose_events:
+            print_event(evt)
+        verbose_events.clear()
+
+def format_rwbs(rwbs_flags):
+    """
+    Rebuild the kernel's rwbs string (e.g. "WS", "FWFS") from an event's rwbs_flags.
+    """
+    rwbs = "F" if rwbs_flags & RWBS_PREFLUSH else ""
+    rwbs += RWBS_OPS.get(rwbs_flags & RWBS_OP_MASK, "N")
+    for flag, char in RWBS_MODIFIERS:
+        if rwbs_flags & flag:
+            rwbs += char
+    return rwbs
+
+@functools.lru_cache(maxsize=256)
 def format_time_us(value_us):
     """
     Convert a latency in microseconds to a human-friendly string with appropriate units.
     For large latencies, use ms or s. This helps in histogram printing.
+    Results are cached, since histogram bucket edges repeat for every device.
     """
     if value_us < 1000:
         value = value_us
@@ -411,6 +621,34 @@ def format_time_us(value_us):
         unit = "s"
     return f"{value:10.2f} {unit:<2}"
 
+def handle_event(ctx, data, size):
+    """
+    Ring buffer callback: copy a completed IO out of the ring buffer into the
+    pending batch, which is added to the histograms when full or by the main loop.
+    With -v, the whole event is also kept for print_event if it will be printed.
+    """
+    global batch_len
+    evt = ct.cast(data, _EVT_P)[0]
+    batch_devs[batch_len] = evt.dev
+    batch_lats[batch_len] = evt.latency_us
+    batch_burst[batch_len] = evt.is_burst
+    batch_len += 1
+
+    if verbose_events is not None and (VERBOSE_LEVEL > 1 or evt.is_burst):
+        verbose_events.append(EVENT_TYPE.from_buffer_copy(evt))
+
+    if batch_len == BATCH_SIZE:
+        flush_latencies()
+
+def init_device_maps(b, dev_keys):
+    """
+    Create the per-device window and stats entries the BPF program updates in place.
+    Devices without entries are ignored by the BPF program.
+    """
+    for dev_key in dev_keys.values():
+        b['io_window'][dev_key] = IOWindow()
+        b['io_stats'][dev_key] = b['io_stats'].Leaf()
+
 def main():
     """
     Parse arguments, attach BPF probes, and run the monitoring loop.
@@ -429,6 +667,11 @@ def main():
                     default=[],
                     help='Only monitor IOs from these PIDs (can accept multiple PIDs separated by whitespace).')
 
+    parser.add_argument('--buffer-pages', type=int, default=1024,
+                        help='Event ring buffer size in pages, a power of two (default: 1024, 4MB with 4K pages).')
+    parser.add_argument('--avoid-irq-cpus', action='store_true',
+                        help='Run this process only on CPUs that do not service the monitored NVMe interrupts.')
+
     unit_group = parser.add_mutually_exclusive_group()
     unit_group.add_argument('-m', '--milliseconds', action='store_true')
     unit_group.add_argument('-s', '--seconds', action='store_true')
@@ -438,6 +681,9 @@ def main():
 
     args = parser.parse_args()
 
+    if args.buffer_pages <= 0 or args.buffer_pages & (args.buffer_pages - 1):
+        parser.error("--buffer-pages must be a power of two")
+
     if args.milliseconds:
         time_unit = 'ms'
     elif args.seconds:
@@ -456,44 +702,80 @@ def main():
 
     print(f"Monitoring devices: {', '.join(devices)}")
 
-    b = BPF(text=bpf_text)
-    set_device_limits(b, devices, args.bandwidth * 1024 * 1024, args.iops)
+    dev_keys = device_keys(devices)
+
+    global hist_devs, latency_counts, latency_time_us
+    hist_devs = np.array([dev_key.value for dev_key in dev_keys.values()], dtype=np.int64)
+    latency_counts = np.zeros((2, hist_devs.size, HIST_BUCKETS), dtype=np.int64)
+    latency_time_us = np.zeros((2, hist_devs.size, HIST_BUCKETS), dtype=np.int64)
+
+    bytes_per_sec = args.bandwidth * 1024 * 1024
+    text = bpf_text.replace('BYTES_PER_SEC_LIMIT', f"{bytes_per_sec}ULL")
+    text = text.replace('IOPS_PER_SEC_LIMIT', f"{args.iops}ULL")
+    text = text.replace('RINGBUF_PAGE_COUNT', str(args.buffer_pages))
+
+    # Only verbose output prints the issuing comm, so only then is it captured
+    global EVENT_TYPE, _EVT_P, VERBOSE_LEVEL, verbose_events
+    VERBOSE_LEVEL = args.verbose
+    cflags = []
+    if args.verbose > 0:
+        cflags.append("-DEVENT_COMM")
+        EVENT_TYPE = EventDataComm
+        _EVT_P = ct.POINTER(EventDataComm)
+        verbose_events = []
+
+    b = BPF(text=text, cflags=cflags)
+    init_device_maps(b, dev_keys)
 
     # If no PIDs specified, means no filtering by PID. We can handle that logic in BPF.
     # If PIDs specified, for each PID, add it to the pid_filter map.
+    # filtering_enabled is an array, so it already reads as 0 when no PIDs are given.
     if args.pid:  # args.pid is a list of PIDs
-        b["filtering_enabled"][ct.c_uint32(0)] = ct.c_ubyte(1)
+        b["filtering_enabled"][ct.c_int(0)] = ct.c_ubyte(1)
         for p in args.pid:
             b["pid_filter"][ct.c_uint32(p)] = ct.c_ubyte(1)
-    else:
-        b["filtering_enabled"][ct.c_uint32(0)] = ct.c_ubyte(0)
 
     global TIME_UNIT_MODE
     TIME_UNIT_MODE = time_unit
 
-    if args.verbose > 0:
-        b["events"].open_perf_buffer(lambda cpu, data, size: print_event(cpu, data, size, args, b))
+    # Keep the poller from competing with NVMe completion handling
+    if args.avoid_irq_cpus:
+        cpus = os.sched_getaffinity(0) - nvme_irq_cpus(dev_keys)
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        else:
+            print("All available CPUs service NVMe interrupts, CPU affinity unchanged")
+
+    b["events"].open_ring_buffer(handle_event)
+
+    global prev_stats_time
+    prev_stats_time = time.monotonic()
 
     iteration = 0
     try:
         while args.count == 0 or iteration < args.count:
-            if args.verbose > 0:
-                # Poll perf buffer to print events
-                start = time.time()
-                while (time.time() - start) < args.interval:
-                    b.perf_buffer_poll(timeout=100)
-            else:
-                time.sleep(args.interval)
-
-            print_stats(b, devices)
+            # Sleep in the ring buffer until woken or the interval elapses;
+            # each wakeup drains every pending event in one pass.
+            deadline = time.monotonic() + args.interval
+            remaining = args.interval
+            while remaining > 0:
+                b.ring_buffer_poll(timeout=max(int(remaining * 1000), 1))
+                remaining = deadline - time.monotonic()
+            # Drain events submitted without a wakeup
+            b.ring_buffer_consume()
+            flush_latencies()
+
+            print_stats(b, devices, dev_keys)
             iteration += 1
     except KeyboardInterrupt:
         pass
     finally:
-        print_latency_histograms(b, devices, "Standard", "latency_hist_normal")
-        print_latency_histograms(b, devices, "Burst", "latency_hist_burst")
+        b.ring_buffer_consume()
+        flush_latencies()
+        print_latency_histograms(devices, dev_keys, "Standard", latency_counts[0], latency_time_us[0])
+        print_latency_histograms(devices, dev_keys, "Burst", latency_counts[1], latency_time_us[1])
         print_concurrency_histogram(concurrency_hist)
-        print_cumulative_stats(b, devices)
+        print_cumulative_stats(b, devices, dev_keys)
 
 def make_dev(major, minor):
     """
@@ -501,6 +783,49 @@ def make_dev(major, minor):
     """
     return (major << 20) | minor
 
+def nvme_irq_cpus(devices):
+    """
+    Return the set of CPUs that service interrupts for the NVMe controllers of the
+    given devices, found through /proc/interrupts and each IRQ's affinity list.
+    """
+    controllers = set()
+    for device in devices:
+        m = re.match(r'/dev/(nvme\d+)n\d+$', device)
+        if m:
+            controllers.add(m.group(1))
+
+    cpus = set()
+    with open('/proc/interrupts') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2 or not fields[0].rstrip(':').isdigit():
+                continue
+            m = re.fullmatch(r'(nvme\d+)q\d+', fields[-1])
+            if not m or m.group(1) not in controllers:
+                continue
+
+            irq = fields[0].rstrip(':')
+            for name in ('effective_affinity_list', 'smp_affinity_list'):
+                try:
+                    with open(f'/proc/irq/{irq}/{name}') as af:
+                        cpus |= parse_cpu_list(af.read())
+                    break
+                except OSError:
+                    continue
+    return cpus
+
+def parse_cpu_list(cpu_list):
+    """
+    Parse a kernel CPU list such as "0-3,8,10-11" into a set of CPU numbers.
+    """
+    cpus = set()
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        low, _, high = part.partition('-')
+        cpus.update(range(int(low), int(high or low) + 1))
+    return cpus
+
 def print_concurrency_histogram(concurrency_hist):
     """
     Print a concurrency histogram showing how often concurrency fell into log2-based buckets.
@@ -524,7 +849,7 @@ def print_concurrency_histogram(concurrency_hist):
         row = f"{range_str:>{range_width}}{c:>{count_width}}"
         print(row)
 
-def print_cumulative_stats(b, devices):
+def print_cumulative_stats(b, devices, dev_keys):
     """
     Print cumulative stats for each device, including normal and burst IO totals.
     """
@@ -561,9 +886,7 @@ def print_cumulative_stats(b, devices):
 
     for device in devices:
         try:
-            st = os.stat(device)
-            dev = (os.major(st.st_rdev) << 20) | os.minor(st.st_rdev)
-            stats = b['io_stats'][ct.c_uint32(dev)]
+            stats = sum_io_stats(b['io_stats'][dev_keys[device]])
             normal_mb = stats.total_normal_bytes / (1024*1024)
             burst_mb = stats.total_burst_bytes / (1024*1024)
             total_iops = stats.total_normal_iops + stats.total_burst_iops
@@ -577,33 +900,37 @@ def print_cumulative_stats(b, devices):
                    f"{total_iops:>{total_ios_width}}"
                    f"{total_mb:>{total_mb_width}.1f}")
             print(row)
-        except (KeyError, FileNotFoundError):
+        except KeyError:
             print(f"{device:<{device_width}}{'No stats available':>{normal_ios_width+normal_mb_width+burst_ios_width+burst_mb_width+total_ios_width+total_mb_width}}")
 
-def print_event(cpu, data, size, args, b):
+    lost = sum_lost_events(b)
+    if lost:
+        print(f"\nLost events: {lost} (ring buffer full; raise --buffer-pages)")
+
+def print_event(evt):
     """
     Print a single IO event if it meets verbosity criteria.
+    Without -v, nothing is printed.
     In -v mode, only burst IOs are printed.
     In -vv mode, all IOs are printed.
     """
-    evt = b["events"].event(data)
-    comm_str = evt.comm.decode('utf-8', 'replace').rstrip('\x00')
-    rwbs_str = evt.rwbs.decode('utf-8', 'replace').rstrip('\x00')
-
-    if args.verbose == 1 and evt.is_burst == 0:
+    if VERBOSE_LEVEL == 0 or (VERBOSE_LEVEL == 1 and evt.is_burst == 0):
         return
 
+    comm_str = evt.comm.split(b'\x00', 1)[0].decode('utf-8', 'replace')
+    rwbs_str = format_rwbs(evt.rwbs_flags)
+
     print(f"VERBOSE: Dev={evt.dev} Comm={comm_str} RWBS={rwbs_str} "
-          f"Size={evt.size}B Latency={evt.latency_us}us "
+          f"Size={evt.size_sectors * 512}B Latency={evt.latency_us}us "
           f"{'BURST' if evt.is_burst else 'NORMAL'}")
 
-def print_latency_histograms(b, devices, title, map_name):
+def print_latency_histograms(devices, dev_keys, title, counts, time_us):
     """
     Print latency histograms for either standard or burst IOs.
     Each bucket is log2-based, showing count and total time spent.
+    counts and time_us are indexed [device row, bucket], with rows in dev_keys order.
     """
     print(f"\n{title} Latency Histogram by Device:")
-    hist_map = b.get_table(map_name)
 
     range_width = 30
     count_width = 10
@@ -622,28 +949,24 @@ def print_latency_histograms(b, devices, title, map_name):
 
     sep_line = "-" * (range_width + count_width + avg_width + total_width + 1)
 
+    rows = {device: row for row, device in enumerate(dev_keys)}
+
     for device in devices:
         try:
-            st = os.stat(device)
-            dev = (os.major(st.st_rdev) << 20) | os.minor(st.st_rdev)
-            device_hist = defaultdict(lambda: [0,0])
-
-            for k, v in hist_map.items():
-                if k.dev == dev:
-                    device_hist[k.bucket][0] = v.count
-                    device_hist[k.bucket][1] = v.total_time_us
+            device_counts = counts[rows[device]]
+            device_ttimes = time_us[rows[device]]
 
             print(f"\nDevice: {device}")
-            if not device_hist:
+            if not device_counts.any():
                 print("No latency data available")
                 continue
 
             print(hdr_line)
             print(sep_line)
 
-            for bucket in sorted(device_hist.keys()):
-                count = device_hist[bucket][0]
-                ttime_us = device_hist[bucket][1]
+            for bucket in np.flatnonzero(device_counts).tolist():
+                count = int(device_counts[bucket])
+                ttime_us = int(device_ttimes[bucket])
                 if count > 0:
                     latency_start_us = (1 << bucket)
                     latency_end_us = ((1 << (bucket + 1)) - 1)
@@ -661,65 +984,83 @@ def print_latency_histograms(b, devices, title, map_name):
                            f"{ttime_str:>{total_width}}")
                     print(row)
 
-        except (KeyError, FileNotFoundError):
+        except KeyError:
             print(f"{device}: No latency data available")
 
-def print_stats(b, devices):
+def print_stats(b, devices, dev_keys):
     """
     Print current interval stats for each device, including IOPS, MB/s, and concurrency.
-    After printing, reset counters for the next interval.
+    Rates are per second, from the change in the cumulative counters since the previous call.
     """
+    global prev_lost_events, prev_stats_time
+    now = time.monotonic()
+    elapsed = max(now - prev_stats_time, 1e-9)
+    prev_stats_time = now
+
     print(f"\n{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("Device            IOPS  MB/s  Burst IOPS  Burst MB/s  MaxConcur")
     print("-" * 65)
 
+    gen_key = ct.c_int(0)
+    gen = b['interval_gen'][gen_key].value
+
     for device in devices:
         try:
-            st = os.stat(device)
-            major = os.major(st.st_rdev)
-            minor = os.minor(st.st_rdev)
-            dev = make_dev(major, minor)
-            stats = b['io_stats'][ct.c_uint32(dev)]
+            dev_key = dev_keys[device]
+            window = b['io_window'][dev_key]
+            stats = sum_io_stats(b['io_stats'][dev_key])
+            prev = prev_stats.get(device, IOStats())
+            prev_stats[device] = stats
+
+            # A window still on an older generation saw no issue this interval,
+            # so its peak is just the current level.
+            if window.gen == gen:
+                max_concurrent = window.max_concurrent
+            else:
+                max_concurrent = window.current_concurrent
 
-            mb_per_sec = stats.bytes / (1024 * 1024)
-            burst_mb_per_sec = stats.burst_bytes / (1024 * 1024)
+            iops = (stats.iops - prev.iops) / elapsed
+            mb_per_sec = (stats.bytes - prev.bytes) / elapsed / (1024 * 1024)
+            burst_iops = (stats.burst_iops - prev.burst_iops) / elapsed
+            burst_mb_per_sec = (stats.burst_bytes - prev.burst_bytes) / elapsed / (1024 * 1024)
 
-            print(f"{device:15} {stats.iops:5} {mb_per_sec:6.1f} {stats.burst_iops:11} "
-                  f"{burst_mb_per_sec:11.1f} {stats.max_concurrent:9}")
+            print(f"{device:15} {iops:5.0f} {mb_per_sec:6.1f} {burst_iops:11.0f} "
+                  f"{burst_mb_per_sec:11.1f} {max_concurrent:9}")
 
             # Update concurrency histogram
-            concurrency = stats.max_concurrent
+            concurrency = max_concurrent
             bucket = 0
             if concurrency > 0:
-                bucket = int(math.log2(concurrency))
+                bucket = concurrency.bit_length() - 1
             concurrency_hist[bucket] += 1
 
-            # Reset stats counters for next iteration
-            stats.bytes = 0
-            stats.iops = 0
-            stats.burst_bytes = 0
-            stats.burst_iops = 0
-            stats.max_concurrent = stats.current_concurrent
-            stats.last_update = int(time.time() * 1e9)
-            b['io_stats'][ct.c_uint32(dev)] = stats
-
-        except (KeyError, FileNotFoundError):
+        except KeyError:
             print(f"{device:15} No stats available")
 
-def set_device_limits(b, device_paths, bytes_per_sec, iops_per_sec):
+    # Start a new interval; BPF restarts each window's peak on its next issue.
+    # The window itself is never written from userspace, so no atomic updates are lost.
+    b['interval_gen'][gen_key] = ct.c_uint64(gen + 1)
+
+    lost = sum_lost_events(b)
+    if lost != prev_lost_events:
+        print(f"Lost events: {lost - prev_lost_events} (ring buffer full; raise --buffer-pages)")
+    prev_lost_events = lost
+
+def sum_io_stats(percpu_stats):
     """
-    Set per-device IO bandwidth and IOPS limits, which define when IOs are considered "burst."
+    Sum the per-CPU copies of a device's IOStats into a single IOStats.
     """
-    limits = IOLimits(bytes_per_sec, iops_per_sec)
-    for device_path in device_paths:
-        try:
-            st = os.stat(device_path)
-            major = os.major(st.st_rdev)
-            minor = os.minor(st.st_rdev)
-            dev = make_dev(major, minor)
-            b['io_limits'][ct.c_uint32(dev)] = limits
-        except FileNotFoundError:
-            print(f"Device {device_path} not found")
+    total = IOStats()
+    for cpu_stats in percpu_stats:
+        for name, _ in IOStats._fields_:
+            setattr(total, name, getattr(total, name) + getattr(cpu_stats, name))
+    return total
+
+def sum_lost_events(b):
+    """
+    Return the number of completions dropped because the ring buffer was full.
+    """
+    return sum(b['lost_events'][ct.c_int(0)])
 
 if __name__ == '__main__':
     main()